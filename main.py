@@ -7,7 +7,7 @@ def fetch_example():
     
     # Fetch churches in northern Europe
     data = fetcher.fetch_data("place_of_worship", "northern_europe")
-    print("Fetched data successfully")
+    print(f"Fetched {len(data['elements'])} elements successfully")
     
     return data
 
@@ -1,8 +1,26 @@
 # location_fetcher/services/data_handler.py
-import json
 from typing import Dict, List, Optional
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from itertools import compress
+from operator import not_
 import os
+import threading
+
+from .json_utils import JSONDecodeError, dumps, load_file, load_file_cached, msgpack_path_for
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import msgspec
+    from . import overpass_schema
+except ImportError:
+    msgspec = None
+    overpass_schema = None
 
 class LocationDataHandler:
     def __init__(self, raw_data_dir: str = "data_cache", filtered_data_dir: str = "filtered_data"):
@@ -14,98 +32,304 @@ class LocationDataHandler:
         self.raw_data_dir.mkdir(exist_ok=True)
         self.filtered_data_dir.mkdir(exist_ok=True)
 
+        # simdjson parsers are reused across files so they keep their parse buffers between
+        # calls, but a parser can't be shared between threads, so each thread gets its own
+        self._local = threading.local()
+
+    def _get_parser(self):
+        """Return the simdjson parser of the current thread, or None without simdjson"""
+        if simdjson is None:
+            return None
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = self._local.parser = simdjson.Parser()
+        return parser
+
     def load_data(self, filename: str) -> dict:
-        """Load a JSON file from the raw data directory"""
+        """Load a JSON file, or a set of its part files, from the raw data directory"""
+        return self._load_json(self.raw_data_dir, filename)
+
+    def load_filtered_data(self, filename: str) -> dict:
+        """Load a JSON file, or a set of its part files, from the filtered data directory"""
+        return self._load_json(self.filtered_data_dir, filename)
+
+    def _load_json(self, directory: Path, filename: str) -> dict:
+        """
+        Load a JSON file from a directory. If it was saved in shards, the part files
+        are parsed in parallel and their elements joined back into one data structure.
+        """
+        file_path = directory / filename
+        if file_path.exists():
+            return load_file_cached(str(file_path))
+        
+        shard_paths = self._shard_paths(directory, filename)
+        if not shard_paths:
+            raise FileNotFoundError(f"File {filename} not found in {directory}")
+        
+        with ThreadPoolExecutor() as executor:
+            parts = list(executor.map(load_file_cached, shard_paths))
+        
+        # A save that was interrupted, or a deleted part file, leaves an incomplete set
+        if [part.get('part') for part in parts] != list(range(parts[0].get('part_count', -1))):
+            raise ValueError(f"Incomplete set of part files for {filename} in {directory}")
+        
+        data = {key: value for key, value in parts[0].items() if key not in ('part', 'part_count', 'elements')}
+        data['elements'] = [elem for part in parts for elem in part['elements']]
+        return data
+
+    def _shard_paths(self, directory: Path, filename: str) -> List[str]:
+        """Return the paths of the part files saved for filename, in part order"""
+        prefix = filename.rsplit('.', 1)[0] + '_part'
+        shards = []
+        for entry in self._json_entries(directory):
+            part = entry.name[len(prefix):-len('.json')]
+            if entry.name.startswith(prefix) and part.isdigit():
+                shards.append((int(part), entry.path))
+        return [path for _, path in sorted(shards)]
+
+    def load_typed_data(self, filename: str):
+        """
+        Load a JSON file from the raw data directory as an overpass_schema.Document.
+        Elements are decoded into structs holding only the fields in the schema, which is
+        faster than building dicts when only those fields are needed. Requires msgspec.
+        """
+        if overpass_schema is None:
+            raise ImportError("msgspec is required to load typed data")
+        
         file_path = self.raw_data_dir / filename
         if not file_path.exists():
             raise FileNotFoundError(f"File {filename} not found in {self.raw_data_dir}")
         
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            return overpass_schema.document_decoder.decode(f.read())
 
-    def save_filtered_data(self, data: dict, original_filename: str, suffix: str = "named_only") -> str:
-        """Save filtered data to the filtered data directory"""
-        # Create filename for filtered data
-        base_name = original_filename.rsplit('.', 1)[0]  # Remove extension
-        new_filename = f"{base_name}_{suffix}.json"
-        file_path = self.filtered_data_dir / new_filename
+    def _load_elements(self, filename: str):
+        """
+        Load the version and elements array of a JSON file from the raw data directory.
+        With msgspec the elements are undecoded JSON, with simdjson they are lazy proxies;
+        either way _element_json turns them back into JSON without building dicts first.
+        """
+        file_path = self.raw_data_dir / filename
+        if not file_path.exists():
+            raise FileNotFoundError(f"File {filename} not found in {self.raw_data_dir}")
         
-        # Save the filtered data
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2)
-            
-        return new_filename
+        if overpass_schema is not None:
+            try:
+                with open(file_path, 'rb') as f:
+                    doc = overpass_schema.raw_document_decoder.decode(f.read())
+                return doc.version, doc.elements
+            except msgspec.MsgspecError:
+                pass
+        
+        parser = self._get_parser()
+        if parser is not None:
+            try:
+                doc = parser.load(str(file_path))
+                return (doc['version'] if 'version' in doc else 0.6), doc['elements']
+            except ValueError:
+                pass
+        
+        data = load_file_cached(str(file_path))
+        return data.get('version', 0.6), data['elements']
 
-    def filter_named_locations(self, filename: str) -> str:
+    @staticmethod
+    def _element_json(elem):
+        """Return the JSON bytes of an element, undecoded msgspec elements are returned as is"""
+        if msgspec is not None and isinstance(elem, msgspec.Raw):
+            return elem
+        if simdjson is not None and isinstance(elem, simdjson.Object):
+            return dumps(elem.as_dict())
+        return dumps(elem)
+
+    @staticmethod
+    def _has_tag(elem, key: str) -> bool:
         """
-        Filter locations that have names and save to a new file.
-        Returns the name of the new filtered file.
+        Check whether an element has the given tag.
+        simdjson proxies are probed with a JSON pointer, so no tags proxy is built for the check.
         """
-        # Load the original data
-        data = self.load_data(filename)
-        
-        # Count original elements
-        original_count = len(data['elements'])
+        if simdjson is not None and isinstance(elem, simdjson.Object):
+            try:
+                elem.at_pointer(f'/tags/{key}')
+                return True
+            except (KeyError, TypeError):
+                return False
+        return 'tags' in elem and key in elem['tags']
+
+    @classmethod
+    def _tag_mask(cls, elements, key: str) -> List[bool]:
+        """
+        Build a column of has-tag flags for the elements in a single pass.
+        Plain dicts are checked inline, without a function call per element.
+        """
+        if msgspec is not None and elements and isinstance(elements[0], msgspec.Raw):
+            return overpass_schema.tag_mask(elements, key)
+        if simdjson is not None and isinstance(elements, simdjson.Array):
+            return [cls._has_tag(elem, key) for elem in elements]
+        return [(key in elem['tags']) if 'tags' in elem else False for elem in elements]
+
+    @classmethod
+    def _select_by_tag(cls, elements, key: str, present: bool = True):
+        """
+        Select the elements that have the given tag, or lack it with present=False.
+        Plain dicts are filtered with an inline comprehension, which is faster than building
+        a mask first; msgspec and simdjson elements are selected through _tag_mask.
+        """
+        if isinstance(elements, list) and (not elements or isinstance(elements[0], dict)):
+            if present:
+                return [elem for elem in elements if 'tags' in elem and key in elem['tags']]
+            return [elem for elem in elements if 'tags' not in elem or key not in elem['tags']]
         
-        # Filter elements that have names
-        filtered_elements = [
-            elem for elem in data['elements']
-            if 'tags' in elem and 'name' in elem['tags']
-        ]
+        mask = cls._tag_mask(elements, key)
+        return compress(elements, mask if present else map(not_, mask))
+
+    def _filtered_filename(self, original_filename: str, suffix: str) -> str:
+        """Build the name of the filtered file for an original file"""
+        base_name = original_filename.rsplit('.', 1)[0]  # Remove extension
+        return f"{base_name}_{suffix}.json"
+
+    def _stream_filtered_elements(self, filename: str, select, suffix: str, filter_type: Optional[str] = None):
+        """
+        Load, filter and save in one pass: the elements of a raw file chosen by select are
+        written straight to a filtered file.
+        select gets the elements array and returns an iterable of the elements to keep.
+        Elements are serialized one at a time, so no filtered copy of the data is built.
+        Returns the new filename with the original and filtered element counts.
+        """
+        version, elements = self._load_elements(filename)
+        original_count = len(elements)
+        filtered_count = 0
         
-        # Create new data structure
-        filtered_data = {
-            'version': data.get('version', 0.6),
+        header = {
+            'version': version,
             'generator': 'Filtered Data',
             'original_file': filename,
-            'filter_type': 'named_only',
+            'filter_type': filter_type or suffix,
             'original_count': original_count,
-            'filtered_count': len(filtered_elements),
-            'elements': filtered_elements
         }
+        new_filename = self._filtered_filename(filename, suffix)
         
-        # Save and return the new filename
-        new_filename = self.save_filtered_data(filtered_data, filename)
+        # Written to a partial file first, so a failed filter never leaves a truncated file
+        file_path = self.filtered_data_dir / new_filename
+        partial_path = f"{file_path}.part"
+        try:
+            with open(partial_path, 'wb') as f:
+                # Reopen the header object to append the elements array and the final count
+                f.write(dumps(header)[:-1] + b',"elements":[')
+                for elem in select(elements):
+                    if filtered_count:
+                        f.write(b',')
+                    f.write(self._element_json(elem))
+                    filtered_count += 1
+                f.write(b'],"filtered_count":%d}' % filtered_count)
+        except BaseException:
+            # The open itself may have failed, don't hide that error behind this one
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial_path)
+            raise
+        
+        # Part files from an earlier sharded save would otherwise be counted alongside this file
+        for path in self._shard_paths(self.filtered_data_dir, new_filename):
+            self._remove_with_copies(path)
+        os.replace(partial_path, file_path)
+        
+        return new_filename, original_count, filtered_count
+
+    @staticmethod
+    def _remove_with_copies(path: str):
+        """Remove a JSON file together with its MessagePack copy, either may be missing"""
+        for file_path in (path, msgpack_path_for(path)):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def save_filtered_data(self, data: dict, original_filename: str, suffix: str = "named_only",
+                           shard_size: Optional[int] = None) -> str:
+        """
+        Save filtered data to the filtered data directory.
+        
+        With shard_size set, data with more elements than that is split into part files
+        (name_part00.json, name_part01.json, ...) of at most shard_size elements each, so
+        they can be parsed in parallel. load_filtered_data reads them back as one.
+        The filter_* methods stream their output to a single file and don't shard.
+        
+        Returns:
+            The name of the filtered file, also for a set of part files
+        """
+        if shard_size is not None and shard_size < 0:
+            raise ValueError(f"shard_size must not be negative, got {shard_size}")
+        
+        # Create filename for filtered data
+        new_filename = self._filtered_filename(original_filename, suffix)
+        file_path = self.filtered_data_dir / new_filename
+        elements = data['elements']
+        
+        # Save the filtered data, compact since the files are only read by code
+        if not shard_size or len(elements) <= shard_size:
+            outputs = {str(file_path): data}
+        else:
+            metadata = {key: value for key, value in data.items() if key != 'elements'}
+            part_count = -(-len(elements) // shard_size)
+            base_name = new_filename.rsplit('.', 1)[0]
+            outputs = {
+                str(self.filtered_data_dir / f"{base_name}_part{part:02d}.json"): {
+                    **metadata,
+                    'part': part,
+                    'part_count': part_count,
+                    'elements': elements[part * shard_size:(part + 1) * shard_size]
+                }
+                for part in range(part_count)
+            }
+        
+        # Everything is written to partial files first, so a failed save leaves the
+        # previous output in place
+        try:
+            for path, content in outputs.items():
+                with open(f"{path}.part", 'wb') as f:
+                    f.write(dumps(content))
+        except BaseException:
+            for path in outputs:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(f"{path}.part")
+            raise
+        
+        # Drop files left by an earlier save under the same name, so they aren't read back
+        for path in self._shard_paths(self.filtered_data_dir, new_filename) + [str(file_path)]:
+            self._remove_with_copies(path)
+        for path in outputs:
+            os.replace(f"{path}.part", path)
+            
+        return new_filename
+
+    def filter_named_locations(self, filename: str) -> str:
+        """
+        Filter locations that have names and save to a new file.
+        Returns the name of the new filtered file.
+        """
+        new_filename, original_count, filtered_count = self._stream_filtered_elements(
+            filename,
+            lambda elements: self._select_by_tag(elements, 'name'),
+            "named_only"
+        )
         
         # Print summary
         print(f"Filtering complete:")
         print(f"Original elements: {original_count}")
-        print(f"Elements with names: {len(filtered_elements)}")
+        print(f"Elements with names: {filtered_count}")
         print(f"Saved to: {self.filtered_data_dir / new_filename}")
         
         return new_filename
     
     def filter_unnamed_locations(self, filename: str) -> str:
-        # Load the original data
-        data = self.load_data(filename)
-        
-        # Count original elements
-        original_count = len(data['elements'])
-        
-        # Filter elements that DON'T have names
-        filtered_elements = [
-            elem for elem in data['elements']
-            if 'tags' not in elem or 'name' not in elem['tags']
-        ]
-        
-        # Create new data structure
-        filtered_data = {
-            'version': data.get('version', 0.6),
-            'generator': 'Filtered Data',
-            'original_file': filename,
-            'filter_type': 'unnamed_only',
-            'original_count': original_count,
-            'filtered_count': len(filtered_elements),
-            'elements': filtered_elements
-        }
-        
-        # Save with an appropriate suffix
-        new_filename = self.save_filtered_data(filtered_data, filename, "unnamed_only")
+        # Keep elements that DON'T have names
+        new_filename, original_count, filtered_count = self._stream_filtered_elements(
+            filename,
+            lambda elements: self._select_by_tag(elements, 'name', present=False),
+            "unnamed_only"
+        )
         
         # Print summary
         print(f"Filtering complete:")
         print(f"Original elements: {original_count}")
-        print(f"Elements without names: {len(filtered_elements)}")
+        print(f"Elements without names: {filtered_count}")
         print(f"Saved to: {self.filtered_data_dir / new_filename}")
         
         return new_filename
@@ -121,54 +345,106 @@ class LocationDataHandler:
         Returns:
             The name of the new filtered file
         """
-        # Load the original data
-        data = self.load_data(filename)
+        # Keep elements that have a Wikipedia tag
+        new_filename, original_count, filtered_count = self._stream_filtered_elements(
+            filename,
+            lambda elements: self._select_by_tag(elements, 'wikipedia'),
+            "with_wikipedia",
+            "wikipedia_only"
+        )
         
-        # Count original elements
-        original_count = len(data['elements'])
+        # Print summary
+        print(f"Filtering complete:")
+        print(f"Original elements: {original_count}")
+        print(f"Places of worship with Wikipedia articles: {filtered_count}")
+        print(f"Saved to: {self.filtered_data_dir / new_filename}")
+        
+        return new_filename
+
+    def get_statistics(self, data: dict) -> Dict[str, int]:
+        """
+        Get basic statistics of already loaded data.
         
-        # Filter elements that have Wikipedia links
-        filtered_elements = []
+        Returns:
+            Dictionary with the total number of elements and the number of named elements
+        """
+        elements = data['elements']
+        return {
+            'total_elements': len(elements),
+            'elements_with_names': sum(self._tag_mask(elements, 'name'))
+        }
+
+    def filter_by_tags(self, data: dict, tags: Dict[str, str]) -> dict:
+        """
+        Keep the elements of already loaded data whose tags match all given key/value pairs.
         
-        for elem in data['elements']:
-            if 'tags' not in elem:
-                continue
-                
-            tags = elem['tags']
+        Args:
+            data: Loaded data with an 'elements' list
+            tags: Tag keys mapped to the values they must have
             
-            # Check if it has a Wikipedia tag
-            if 'wikipedia' in tags:
-                filtered_elements.append(elem)
+        Returns:
+            New data structure with the matching elements
+        """
+        # Each tag narrows down the candidates, so later checks only see elements
+        # that passed the earlier ones instead of every element again
+        candidates = [(elem, elem.get('tags', {})) for elem in data['elements']]
+        for key, value in tags.items():
+            candidates = [
+                (elem, elem_tags) for elem, elem_tags in candidates
+                if elem_tags.get(key) == value
+            ]
+        
+        filtered_elements = [elem for elem, _ in candidates]
         
-        # Create new data structure
-        filtered_data = {
+        return {
             'version': data.get('version', 0.6),
             'generator': 'Filtered Data',
-            'original_file': filename,
-            'filter_type': 'wikipedia_only',
-            'original_count': original_count,
+            'filter_type': 'by_tags',
+            'filter_tags': tags,
+            'original_count': len(data['elements']),
             'filtered_count': len(filtered_elements),
             'elements': filtered_elements
         }
-        
-        # Save with an appropriate suffix
-        new_filename = self.save_filtered_data(filtered_data, filename, "with_wikipedia")
-        
-        # Print summary
-        print(f"Filtering complete:")
-        print(f"Original elements: {original_count}")
-        print(f"Places of worship with Wikipedia articles: {len(filtered_elements)}")
-        print(f"Saved to: {self.filtered_data_dir / new_filename}")
-        
-        return new_filename
+
+    @staticmethod
+    def _json_entries(directory: Path) -> List[os.DirEntry]:
+        """List the JSON files of a directory as scandir entries, without building a Path for each"""
+        with os.scandir(directory) as entries:
+            return [entry for entry in entries if entry.name.endswith('.json') and entry.is_file()]
 
     def list_raw_files(self) -> List[str]:
         """List all JSON files in the raw data directory"""
-        return [f.name for f in self.raw_data_dir.glob("*.json")]
+        return [entry.name for entry in self._json_entries(self.raw_data_dir)]
 
     def list_filtered_files(self) -> List[str]:
         """List all JSON files in the filtered data directory"""
-        return [f.name for f in self.filtered_data_dir.glob("*.json")]
+        return [entry.name for entry in self._json_entries(self.filtered_data_dir)]
+
+    def _count_elements(self, file_path: str) -> int:
+        """
+        Count the elements in a JSON file.
+        With simdjson only the length of the elements array is read, no element objects are built.
+        """
+        parser = self._get_parser()
+        if parser is not None:
+            try:
+                doc = parser.load(file_path)
+                num_objects = len(doc['elements']) if 'elements' in doc else 0
+                # The parser can't be reused while proxies into its document are alive
+                del doc
+                return num_objects
+            except ValueError:
+                pass
+
+        data = load_file(file_path)
+        return len(data.get('elements', []))
+
+    def _count_file(self, entry: os.DirEntry):
+        """Count the elements in one file, returning its name and None as the count if it can't be read"""
+        try:
+            return entry.name, self._count_elements(entry.path)
+        except JSONDecodeError:
+            return entry.name, None
 
     def count_objects(self) -> Dict[str, Dict[str, int]]:
         """
@@ -180,29 +456,23 @@ class LocationDataHandler:
             'filtered_data': {'total_objects': 0, 'files': {}}
         }
         
-        # Count objects in raw data files
-        for file in self.raw_data_dir.glob("*.json"):
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    num_objects = len(data.get('elements', []))
-                    counts['raw_data']['files'][file.name] = num_objects
-                    counts['raw_data']['total_objects'] += num_objects
-            except json.JSONDecodeError:
-                print(f"Error reading file {file.name} in raw data directory")
-                counts['raw_data']['files'][file.name] = 0
-        
-        # Count objects in filtered data files
-        for file in self.filtered_data_dir.glob("*.json"):
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    num_objects = len(data.get('elements', []))
-                    counts['filtered_data']['files'][file.name] = num_objects
-                    counts['filtered_data']['total_objects'] += num_objects
-            except json.JSONDecodeError:
-                print(f"Error reading file {file.name} in filtered data directory")
-                counts['filtered_data']['files'][file.name] = 0
+        raw_files = self._json_entries(self.raw_data_dir)
+        filtered_files = self._json_entries(self.filtered_data_dir)
+        
+        # Files are read and parsed in parallel, results are collected in order
+        with ThreadPoolExecutor() as executor:
+            results = [
+                ('raw_data', 'raw data', executor.map(self._count_file, raw_files)),
+                ('filtered_data', 'filtered data', executor.map(self._count_file, filtered_files))
+            ]
+            
+            for key, label, file_counts in results:
+                for name, num_objects in file_counts:
+                    if num_objects is None:
+                        print(f"Error reading file {name} in {label} directory")
+                        num_objects = 0
+                    counts[key]['files'][name] = num_objects
+                    counts[key]['total_objects'] += num_objects
         
         return counts
 
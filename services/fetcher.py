@@ -1,16 +1,56 @@
 import os
 from datetime import datetime
 import requests
-from typing import Dict, List, Tuple
-import json
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import time
 
+from .json_utils import dumps, load_file_cached, loads
+
 class OverpassFetcher:
-    def __init__(self, cache_dir: str = "data_cache"):
+    QUERY_TEMPLATE = """
+            [out:json][timeout:300];
+            (
+              node["{tag_key}"="{tag_value}"]
+                ({bbox});
+              way["{tag_key}"="{tag_value}"]
+                ({bbox});
+              relation["{tag_key}"="{tag_value}"]
+                ({bbox});
+            );
+            out body;
+            >;
+            out skel qt;
+        """
+
+    def __init__(self, cache_dir: str = "data_cache", max_concurrent_requests: int = 2):
         self.cache_dir = cache_dir
         self.ensure_cache_directory()
         
+        # overpass-api.de only serves a couple of requests per client at a time, more get rejected
+        self.max_concurrent_requests = max_concurrent_requests
+        
+        # One session for all requests so connections (and TLS sessions) are kept alive
+        # between subareas, with compressed responses to cut the transfer size
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests))
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "User-Agent": "location-fetcher"
+        })
+        
+        # (tag key, tag value) for each supported location type
+        self.tag_mapping: Dict[str, Tuple[str, str]] = {
+            "place_of_worship": ("amenity", "place_of_worship"),
+            "police": ("amenity", "police"),
+            "park": ("leisure", "park"),
+            "school": ("amenity", "school"),
+            "hospital": ("amenity", "hospital"),
+            "restaurant": ("amenity", "restaurant"),
+        }
+        
         self.areas: Dict[str, Dict] = {
             "northern_europe": {
                 "bounds": (55.0, 4.0, 71.0, 32.0),
@@ -41,7 +81,7 @@ class OverpassFetcher:
             }
         }
      
-    def fetch_finland_worship_places(self, cache_name: str = "finland_worship_places") -> str:
+    def fetch_finland_worship_places(self, cache_name: str = "finland_worship_places") -> dict:
         """
         Fetch all places of worship within Finland's borders using administrative boundary.
         This approach ensures only places within Finland are included, not neighboring countries.
@@ -50,15 +90,14 @@ class OverpassFetcher:
             cache_name: Name to use for the cache file (default: 'finland_worship_places')
             
         Returns:
-            JSON string with all places of worship data in Finland
+            Dictionary with all places of worship data in Finland
         """
         cache_file = f"{self.cache_dir}/{cache_name}_{datetime.now().strftime('%Y%m%d')}.json"
         
         # Check if we already have cached data for today
         if os.path.exists(cache_file):
             print(f"Using cached Finland places of worship data from {cache_file}")
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return f.read()
+            return load_file_cached(cache_file)
         
         print(f"Fetching all places of worship in Finland using administrative boundary")
         
@@ -92,15 +131,15 @@ class OverpassFetcher:
                 "elements": elements
             }
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(combined_data, f)
+            with open(cache_file, 'wb') as f:
+                f.write(dumps(combined_data))
             print(f"Saved {len(elements)} places of worship to cache file: {cache_file}")
             
-            return json.dumps(combined_data)
+            return combined_data
             
         except Exception as e:
             print(f"Error fetching data: {str(e)}")
-            return json.dumps({"version": 0.6, "generator": "Overpass API", "elements": []})
+            return {"version": 0.6, "generator": "Overpass API", "elements": []}
         
     def ensure_cache_directory(self):
         if not os.path.exists(self.cache_dir):
@@ -112,52 +151,24 @@ class OverpassFetcher:
             raise ValueError(f"Unknown area: {area_name}. Available areas: {list(self.areas.keys())}")
         return self.areas[area_name]["subareas"]
 
-    def get_tag_key(self, node_type: str) -> str:
-        tag_mapping = {
-            "place_of_worship": "amenity",
-            "police": "amenity",
-            "park": "leisure",
-            "school": "amenity",
-            "hospital": "amenity",
-            "restaurant": "amenity",
-        }
-        return tag_mapping.get(node_type, node_type)
-
-    def get_tag_value(self, node_type: str) -> str:
-        value_mapping = {
-            "place_of_worship": "place_of_worship",
-            "police": "police",
-            "park": "park",
-            "school": "school",
-            "hospital": "hospital",
-            "restaurant": "restaurant",
-        }
-        return value_mapping.get(node_type, node_type)
-
     def build_query(self, node_type: str, bounds: Tuple[float, float, float, float]) -> str:
+        tag_key, tag_value = self.tag_mapping.get(node_type, (node_type, node_type))
         min_lat, min_lon, max_lat, max_lon = bounds
         
-        query = f"""
-            [out:json][timeout:300];
-            (
-              node["{self.get_tag_key(node_type)}"="{self.get_tag_value(node_type)}"]
-                ({min_lat},{min_lon},{max_lat},{max_lon});
-              way["{self.get_tag_key(node_type)}"="{self.get_tag_value(node_type)}"]
-                ({min_lat},{min_lon},{max_lat},{max_lon});
-              relation["{self.get_tag_key(node_type)}"="{self.get_tag_value(node_type)}"]
-                ({min_lat},{min_lon},{max_lat},{max_lon});
-            );
-            out body;
-            >;
-            out skel qt;
-        """
-        return query
+        return self.QUERY_TEMPLATE.format(
+            tag_key=tag_key,
+            tag_value=tag_value,
+            bbox=f"{min_lat},{min_lon},{max_lat},{max_lon}"
+        )
 
-    def fetch_with_progress(self, query: str, retries: int = 3, delay: int = 5) -> dict:
+    def fetch_with_progress(self, query: str, retries: int = 3, delay: int = 5,
+                            position: Optional[int] = None, desc: str = "Downloading data") -> dict:
+        # Messages go through tqdm.write so they don't break up progress bars of concurrent
+        # downloads, each of which is drawn on its own line given by position
         for attempt in range(retries):
             try:
-                print(f"Sending request... (attempt {attempt + 1}/{retries})")
-                response = requests.post(
+                tqdm.write(f"{desc}: sending request... (attempt {attempt + 1}/{retries})")
+                response = self.session.post(
                     "https://overpass-api.de/api/interpreter",
                     data={"data": query},
                     timeout=60,
@@ -166,70 +177,96 @@ class OverpassFetcher:
                 response.raise_for_status()
                 
                 total_size = int(response.headers.get('content-length', 0))
-                block_size = 1024
-                progress_bar = tqdm(
+                # Large blocks keep the per-chunk Python overhead down on big responses
+                block_size = 64 * 1024
+                content = bytearray()
+                with tqdm(
                     total=total_size,
                     unit='iB',
                     unit_scale=True,
-                    desc="Downloading data"
-                )
+                    desc=desc,
+                    position=position,
+                    leave=position is None
+                ) as progress_bar:
+                    for data in response.iter_content(block_size):
+                        # content-length is the compressed size, so track the bytes read off the wire
+                        progress_bar.update(response.raw.tell() - progress_bar.n)
+                        content.extend(data)
                 
-                content = bytearray()
-                for data in response.iter_content(block_size):
-                    progress_bar.update(len(data))
-                    content.extend(data)
-                
-                progress_bar.close()
-                return json.loads(content)
+                # Parsed straight from the buffer, without copying it into bytes first
+                return loads(content)
                 
             except requests.exceptions.RequestException as e:
-                print(f"Error during attempt {attempt + 1}: {str(e)}")
+                tqdm.write(f"{desc}: error during attempt {attempt + 1}: {str(e)}")
                 if attempt < retries - 1:
-                    print(f"Retrying in {delay} seconds...")
+                    tqdm.write(f"{desc}: retrying in {delay} seconds...")
                     time.sleep(delay)
                 else:
                     raise
 
-    def fetch_data(self, node_type: str, area_name: str) -> str:
+    def fetch_data(self, node_type: str, area_name: str) -> dict:
         cache_file = f"{self.cache_dir}/{node_type}_{area_name}_{datetime.now().strftime('%Y%m%d')}.json"
         
         if os.path.exists(cache_file):
             print(f"Using cached data from {cache_file}")
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                return f.read()
+            return load_file_cached(cache_file)
         
-        all_elements = []
         subareas = self.get_subareas(area_name)
         
         print(f"\nFetching {node_type} data for {area_name}")
         print(f"Total subareas to process: {len(subareas)}")
         
-        for idx, subarea in enumerate(subareas, 1):
-            min_lat, min_lon, max_lat, max_lon = subarea
-            print(f"\nProcessing subarea {idx}/{len(subareas)}")
-            print(f"Bounds: {min_lat:.2f}°N, {min_lon:.2f}°E to {max_lat:.2f}°N, {max_lon:.2f}°E")
+        # Subarea requests run concurrently, and their elements are appended to the file in
+        # subarea order as each response is ready. Writing to a partial file keeps an
+        # interrupted fetch from being picked up as today's cache.
+        partial_file = f"{cache_file}.part"
+        has_elements = False
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor, \
+                open(partial_file, 'wb') as f:
+            # Each subarea's download gets its own progress bar line
+            futures = [
+                executor.submit(
+                    self.fetch_with_progress,
+                    self.build_query(node_type, subarea),
+                    position=idx,
+                    desc=f"Subarea {idx + 1}/{len(subareas)}"
+                )
+                for idx, subarea in enumerate(subareas)
+            ]
             
-            query = self.build_query(node_type, subarea)
-            try:
-                data = self.fetch_with_progress(query)
-                elements = data.get("elements", [])
-                all_elements.extend(elements)
-                print(f"Found {len(elements)} elements in this subarea")
+            f.write(b'{"version":0.6,"generator":"Overpass API","elements":[')
+            
+            for idx, subarea in enumerate(subareas, 1):
+                # Drop each future once it's handled so its response can be freed
+                future = futures.pop(0)
                 
-            except Exception as e:
-                print(f"Error processing subarea {idx}: {str(e)}")
-                continue
-        
-        combined_data = {
-            "version": 0.6,
-            "generator": "Overpass API",
-            "elements": all_elements
-        }
+                try:
+                    data = future.result()
+                    elements = data.get("elements", [])
+                except Exception as e:
+                    tqdm.write(f"\nError processing subarea {idx}: {str(e)}")
+                    continue
+                
+                min_lat, min_lon, max_lat, max_lon = subarea
+                tqdm.write(f"\nProcessed subarea {idx}/{len(subareas)}")
+                tqdm.write(f"Bounds: {min_lat:.2f}°N, {min_lon:.2f}°E to {max_lat:.2f}°N, {max_lon:.2f}°E")
+                tqdm.write(f"Found {len(elements)} elements in this subarea")
+                
+                if elements:
+                    if has_elements:
+                        f.write(b',')
+                    # Serialize the whole array once and drop its brackets
+                    f.write(memoryview(dumps(elements))[1:-1])
+                    has_elements = True
+                del data, elements
+            
+            f.write(b']}')
         
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(combined_data, f)
+        os.replace(partial_file, cache_file)
         
-        return json.dumps(combined_data)
+        # The elements were never combined in memory, so parse the finished file once,
+        # which also writes its MessagePack copy for later loads
+        return load_file_cached(cache_file)
 
 
 # Example usage:
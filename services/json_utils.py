@@ -0,0 +1,89 @@
+# location_fetcher/services/json_utils.py
+import json
+import mmap
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ormsgpack
+except ImportError:
+    ormsgpack = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can catch this either way
+JSONDecodeError = orjson.JSONDecodeError if orjson is not None else json.JSONDecodeError
+
+
+def loads(raw) -> dict:
+    """Parse UTF-8 encoded JSON bytes, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    # json accepts bytes and bytearray as is, other buffers (memoryview, mmap) need a copy
+    if isinstance(raw, (bytes, bytearray)):
+        return json.loads(raw)
+    return json.loads(bytes(raw))
+
+
+def dumps(data) -> bytes:
+    """Serialize data to compact UTF-8 encoded JSON bytes, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def load_file(file_path) -> dict:
+    """Parse a JSON file through a read-only memory map, without copying it into a bytes object"""
+    with open(file_path, 'rb') as f:
+        # Empty files can't be mapped, parsing the empty buffer raises the usual decode error
+        if os.fstat(f.fileno()).st_size == 0:
+            return loads(b'')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            return loads(view)
+
+
+def load_file_cached(file_path) -> dict:
+    """
+    Load a JSON file through a MessagePack copy kept next to it (name.msgpack).
+    The copy is written on the first load and is given the JSON file's modification time;
+    it is only used while the two times are equal. Without ormsgpack, or if the copy
+    can't be written, this is the same as load_file.
+    """
+    if ormsgpack is None:
+        return load_file(file_path)
+    
+    msgpack_path = msgpack_path_for(file_path)
+    source_stat = os.stat(file_path)
+    try:
+        if os.stat(msgpack_path).st_mtime_ns == source_stat.st_mtime_ns:
+            with open(msgpack_path, 'rb') as f:
+                return ormsgpack.unpackb(f.read())
+    except (OSError, ValueError):
+        # Missing, stale or unreadable copy, rebuild it from the JSON file below
+        pass
+    
+    data = load_file(file_path)
+    
+    # Written under a temporary name so a half-written copy is never picked up
+    partial_path = f"{msgpack_path}.part"
+    try:
+        with open(partial_path, 'wb') as f:
+            f.write(ormsgpack.packb(data))
+        os.utime(partial_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(partial_path, msgpack_path)
+    except (OSError, TypeError):
+        # The copy is only a speed-up: a read-only or full disk, or a value MessagePack can't
+        # encode (ormsgpack.MsgpackEncodeError is a TypeError), shouldn't fail the load
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+    
+    return data
+
+
+def msgpack_path_for(file_path) -> str:
+    """Return the path of the MessagePack copy kept for a JSON file"""
+    return os.path.splitext(file_path)[0] + '.msgpack'
@@ -0,0 +1,80 @@
+# location_fetcher/services/overpass_schema.py
+from typing import Any, List, Optional
+
+import msgspec
+
+
+class Tags(msgspec.Struct):
+    """The tags of an element that this project reads, any other tags are skipped when decoding"""
+    name: Optional[str] = None
+    amenity: Optional[str] = None
+    religion: Optional[str] = None
+    denomination: Optional[str] = None
+    wikipedia: Optional[str] = None
+
+
+class Element(msgspec.Struct):
+    type: str
+    id: int
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    tags: Optional[Tags] = None
+
+
+class Document(msgspec.Struct):
+    elements: List[Element]
+    version: float = 0.6
+    generator: Optional[str] = None
+
+
+class RawDocument(msgspec.Struct):
+    """A document whose elements are kept as undecoded JSON"""
+    elements: List[msgspec.Raw]
+    version: float = 0.6
+
+
+class _TagsProbe(msgspec.Struct):
+    """
+    Presence of the filtered tags. Values are not validated and a present key is never
+    UNSET, even when its value is null, matching the dict and simdjson checks.
+    """
+    name: Any = msgspec.UNSET
+    wikipedia: Any = msgspec.UNSET
+
+
+class _ElementProbe(msgspec.Struct):
+    """Only the tags of an element, kept undecoded; no other field is decoded or validated"""
+    tags: msgspec.Raw = msgspec.UNSET
+
+
+document_decoder = msgspec.json.Decoder(Document)
+raw_document_decoder = msgspec.json.Decoder(RawDocument)
+_element_probe_decoder = msgspec.json.Decoder(_ElementProbe)
+_tags_probe_decoder = msgspec.json.Decoder(_TagsProbe)
+
+
+def tag_mask(elements: List[msgspec.Raw], key: str) -> List[bool]:
+    """
+    Build a column of has-tag flags for undecoded elements.
+    Tags in the probe struct are checked without building dicts, others fall back to them.
+    """
+    if key not in _TagsProbe.__struct_fields__:
+        return [_has_tag_dict(msgspec.json.decode(elem), key) for elem in elements]
+
+    return [_has_tag(elem, key) for elem in elements]
+
+
+def _has_tag(elem: msgspec.Raw, key: str) -> bool:
+    try:
+        tags = _element_probe_decoder.decode(elem).tags
+        if tags is msgspec.UNSET:
+            return False
+        return getattr(_tags_probe_decoder.decode(tags), key) is not msgspec.UNSET
+    except msgspec.ValidationError:
+        # The element or its tags aren't objects, so there is no such tag
+        return False
+
+
+def _has_tag_dict(elem, key: str) -> bool:
+    tags = elem.get('tags') if isinstance(elem, dict) else None
+    return isinstance(tags, dict) and key in tags
@@ -10,22 +10,33 @@ def analyze_data(filepath: str):
     
     elements = data['elements']
     
+    # Gather all statistics in a single pass over the elements
+    type_counts = Counter()
+    all_tags = set()
+    religions = Counter()
+    denominations = Counter()
+    for elem in elements:
+        type_counts[elem['type']] += 1
+        tags = elem.get('tags')
+        if tags:
+            all_tags.update(tags)
+            religion = tags.get('religion')
+            denomination = tags.get('denomination')
+            if religion:
+                religions[religion] += 1
+            if denomination:
+                denominations[denomination] += 1
+    
     # Basic statistics
     print(f"\n=== Basic Statistics ===")
     print(f"Total number of elements: {len(elements)}")
     
     # Count elements by type
-    type_counts = Counter(elem['type'] for elem in elements)
     print("\n=== Element Types ===")
     for type_name, count in type_counts.items():
         print(f"{type_name}: {count}")
     
     # Analyze available tags
-    all_tags = set()
-    for elem in elements:
-        if 'tags' in elem:
-            all_tags.update(elem['tags'].keys())
-    
     print("\n=== Available Tags ===")
     print(", ".join(sorted(all_tags)))
     
@@ -36,28 +47,27 @@ def analyze_data(filepath: str):
         print("-" * 50)
     
     # Summary of religious buildings
-    religions = Counter(elem.get('tags', {}).get('religion') for elem in elements)
     print("\n=== Religions ===")
     for religion, count in religions.items():
-        if religion:  # Skip None values
-            print(f"{religion}: {count}")
+        print(f"{religion}: {count}")
     
     # Summary of denominations
-    denominations = Counter(elem.get('tags', {}).get('denomination') for elem in elements)
     print("\n=== Denominations ===")
     for denomination, count in denominations.items():
-        if denomination:  # Skip None values
-            print(f"{denomination}: {count}")
+        print(f"{denomination}: {count}")
 
 def search_locations(filepath: str, search_term: str):
     """Search for locations containing the search term in their name"""
     with open(filepath, 'r', encoding='utf-8') as f:
         data = json.load(f)
     
+    # Lowercased once here instead of once per element
+    search_term_lower = search_term.lower()
+    
     print(f"\n=== Search Results for '{search_term}' ===")
     for elem in data['elements']:
         name = elem.get('tags', {}).get('name', '')
-        if name and search_term.lower() in name.lower():
+        if name and search_term_lower in name.lower():
             print(f"\nName: {name}")
             print(f"Location: {elem.get('lat')}, {elem.get('lon')}")
             print(f"Tags: {elem.get('tags')}")